@@ -1,18 +1,200 @@
-import sys
 import os
 import logging
 import json
+import base64
+import threading
 import requests
-from time import sleep
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from time import sleep, monotonic
 from github import Github
 from github import GithubException
 
 log_level = os.getenv('LOG_LEVEL', 'INFO')
-logging.basicConfig(
-  format='[%(asctime)s] %(levelname)s %(threadName)s %(message)s', level=log_level
-)
+# Leave logging alone if whatever imported this has already set it up
+if not logging.getLogger().handlers:
+  logging.basicConfig(
+    format='[%(asctime)s] %(levelname)s %(threadName)s %(message)s', level=log_level
+  )
 log = logging.getLogger(__name__)
 
+GITHUB_API_URL = 'https://api.github.com'
+# The fields from a project request that are written to its json file
+REQUEST_JSON_FIELDS = frozenset(
+  [
+    'github_repo',
+    'repo_description',
+    'base_template',
+    'jira_project_keys',
+    'github_project_visibility',
+    'product',
+    'github_project_teams_write',
+    'github_projects_teams_admin',
+    'github_project_branch_protection_restricted_teams',
+    'prod_alerts_severity_label',
+    'nonprod_alerts_severity_label',
+    'slack_channel_nonprod_release_notify',
+    'slack_channel_prod_release_notify',
+    'slack_channel_security_scans_notify',
+    'requester_name',
+    'requester_email',
+    'requester_team',
+  ]
+)
+# (connect, read) timeout in seconds for REST and GraphQL calls
+HTTP_TIMEOUT = (10, 60)
+# Github calls are network bound - this is how many are allowed in flight at once
+MAX_WORKERS = 8
+# Github's secondary rate limits are much tighter for writes (content creation)
+# so fewer of those are allowed at once
+MAX_CONCURRENT_WRITES = 4
+# Backoff (in seconds) when waiting for a newly created repo to become ready
+REPO_READY_ATTEMPTS = 12
+REPO_READY_INITIAL_DELAY = 0.1
+REPO_READY_MAX_DELAY = 4.0
+# Number of most recent bootstrap workflow runs to hang on to
+WORKFLOW_RUNS_TO_KEEP = 12
+# Most responses kept in the ETag cache - the least recently used go first
+ETAG_CACHE_MAX_ENTRIES = 500
+# How long (in seconds) org level lists like teams and runner groups are reused
+CACHE_TTL = 300
+
+TEAMS_QUERY = '''
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    teams(first: 100, after: $cursor) {
+      nodes { databaseId name slug }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+'''
+
+# Whether the request branch exists and whether it already has an open PR -
+# answered in one round trip rather than a REST call for each
+BRANCH_STATUS_QUERY = '''
+query($owner: String!, $repo: String!, $ref: String!, $branch: String!) {
+  repository(owner: $owner, name: $repo) {
+    ref(qualifiedName: $ref) { target { oid } }
+    pullRequests(headRefName: $branch, baseRefName: "main", states: OPEN, first: 100) {
+      nodes { number headRepositoryOwner { login } }
+    }
+  }
+}
+'''
+
+ENABLE_AUTOMERGE_MUTATION = '''
+mutation($pullRequestId: ID!) {
+  enablePullRequestAutoMerge(input: {pullRequestId: $pullRequestId, mergeMethod: MERGE}) {
+    clientMutationId
+  }
+}
+'''
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+  # requests waits forever by default - a stalled connection would hang a pool
+  # worker and read timeouts would never reach the retry policy
+  def send(self, request, **kwargs):
+    if kwargs.get('timeout') is None:
+      kwargs['timeout'] = HTTP_TIMEOUT
+    return super().send(request, **kwargs)
+
+
+def _github_adapter(allowed_methods):
+  # Pooled connections, backing off on transient errors for allowed_methods.
+  # Only 429 and 5xx are retried - secondary rate limit 403s are not.
+  return _TimeoutHTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+      total=5,
+      backoff_factor=0.5,
+      status_forcelist=[429, 500, 502, 503, 504],
+      respect_retry_after_header=True,
+      allowed_methods=frozenset(allowed_methods),
+      raise_on_status=False,
+    ),
+  )
+
+
+class GithubProjectError(Exception):
+  # Raised instead of exiting so that a batch can carry on with other requests
+  pass
+
+
+class _CachedSession(requests.Session):
+  # requests Session that remembers the ETag of each GET and sends it back as
+  # If-None-Match next time. GitHub answers with an empty 304 when nothing has
+  # changed (which doesn't count against the rate limit) and the cached body is
+  # handed back to the caller as if it were a normal 200.
+  # Without a cache_file it behaves like a plain Session. The cache is written
+  # back to cache_file on close().
+  def __init__(self, cache_file=None, max_entries=ETAG_CACHE_MAX_ENTRIES):
+    super().__init__()
+    self.cache_file = cache_file
+    self.max_entries = max_entries
+    self.cache_lock = threading.Lock()
+    self.etag_cache = {}
+    if self.cache_file:
+      try:
+        with open(self.cache_file) as f:
+          self.etag_cache = json.load(f)
+      except (OSError, ValueError):
+        pass
+      self._prune()
+
+  def _prune(self):
+    # dicts keep insertion order and hits are moved to the end, so the first
+    # entries are the least recently used
+    while len(self.etag_cache) > self.max_entries:
+      del self.etag_cache[next(iter(self.etag_cache))]
+
+  def request(self, method, url, *args, **kwargs):
+    if not self.cache_file or method.upper() != 'GET':
+      return super().request(method, url, *args, **kwargs)
+
+    cache_key = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+    with self.cache_lock:
+      if cached := self.etag_cache.pop(cache_key, None):
+        self.etag_cache[cache_key] = cached
+    if cached:
+      kwargs['headers'] = {
+        **(kwargs.get('headers') or {}),
+        'If-None-Match': cached['etag'],
+      }
+
+    response = super().request(method, url, *args, **kwargs)
+    if response.status_code == 304 and cached:
+      log.debug('Not modified - using cached response for %s', cache_key)
+      response.status_code = 200
+      response.encoding = 'utf-8'
+      response._content = cached['body'].encode('utf-8')
+    elif response.status_code == 200 and response.headers.get('ETag'):
+      with self.cache_lock:
+        self.etag_cache.pop(cache_key, None)
+        self.etag_cache[cache_key] = {
+          'etag': response.headers['ETag'],
+          'body': response.text,
+        }
+        self._prune()
+    return response
+
+  def save(self):
+    if not self.cache_file:
+      return
+    try:
+      with self.cache_lock, open(self.cache_file, 'w') as f:
+        json.dump(self.etag_cache, f)
+    except OSError as e:
+      log.warning(f'Unable to save Github ETag cache to {self.cache_file}: {e}')
+
+  def close(self):
+    self.save()
+    super().close()
+
 
 class GithubProject:
   def __init__(self, github_params):
@@ -20,155 +202,415 @@ class GithubProject:
       self.github_bootstrap_repo = github_params['github_bootstrap_repo']
       self.github_org = github_params['github_org']
       self.github_access_token = github_params['github_access_token']
+      self.headers = {
+        'Authorization': f'token {self.github_access_token}',
+        'Accept': 'application/vnd.github.v3+json',
+      }
       self.session = Github(self.github_access_token)
-      self.org = self.session.get_organization(self.github_org)
-      self.bootstrap_repo = self.session.get_repo(
-        f'{self.github_org}/{self.github_bootstrap_repo}'
+      self.bootstrap_url = (
+        f'{GITHUB_API_URL}/repos/{self.github_org}/{self.github_bootstrap_repo}'
       )
+      # Conditional (ETag) requests for REST reads - only if a file to keep
+      # the cache in has been given
+      self.http = _CachedSession(github_params.get('github_etag_cache_file'))
+      self.http.headers.update(self.headers)
+      # Keep connections open between calls and back off on transient errors
+      self.http.mount('https://', _github_adapter(['GET', 'PUT', 'POST', 'DELETE']))
+      # Creating a repo, branch or PR isn't safe to replay - if Github acted on
+      # the first attempt a retry fails with 'already exists' - so those POSTs
+      # go through a session that only retries the other methods
+      self.create_http = requests.Session()
+      self.create_http.headers.update(self.headers)
+      self.create_http.mount('https://', _github_adapter(['GET', 'PUT', 'DELETE']))
+      # sha of the bootstrap repo main branch - fetched once per run
+      self.main_sha = None
+      # (timestamp, value) pairs for the org level lookups below
+      self.cache = {}
+      self.write_semaphore = threading.Semaphore(MAX_CONCURRENT_WRITES)
       log.debug(
-        f'Initialised GithubProject - bootstrap repo is {self.bootstrap_repo.name}'
+        'Initialised GithubProject - bootstrap repo is %s', self.github_bootstrap_repo
       )
 
     except Exception as e:
-      log.error(f'Unable to initialise Github session: {e}')
-      sys.exit(1)
+      raise GithubProjectError(f'Unable to initialise Github session: {e}')
+
+  def close(self):
+    # Saves the ETag cache (if there is one) and releases pooled connections
+    self.http.close()
+    self.create_http.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  # The PyGithub org and bootstrap repo objects each cost a request to load,
+  # so only fetch them the first time they're actually used
+  @cached_property
+  def org(self):
+    try:
+      return self.session.get_organization(self.github_org)
+    except Exception as e:
+      raise GithubProjectError(
+        f'Unable to load Github organisation {self.github_org}: {e}'
+      )
+
+  @cached_property
+  def bootstrap_repo(self):
+    try:
+      return self.session.get_repo(f'{self.github_org}/{self.github_bootstrap_repo}')
+    except Exception as e:
+      raise GithubProjectError(
+        f'Unable to load Github bootstrap repo {self.github_bootstrap_repo}: {e}'
+      )
+
+  def _paginate(self, url, key=None):
+    # Yield the items of a REST list endpoint 100 at a time (the maximum page
+    # size) - the next page is only fetched if the caller keeps iterating.
+    # key is the name of the list for endpoints that wrap it in an object
+    # (eg. workflow_runs)
+    page = 1
+    while True:
+      r = self.http.get(url, params={'per_page': 100, 'page': page})
+      r.raise_for_status()
+      page_items = r.json()[key] if key else r.json()
+      yield from page_items
+      if len(page_items) < 100:
+        return
+      page += 1
+
+  def _graphql(self, query, variables):
+    r = self.http.post(
+      f'{GITHUB_API_URL}/graphql', json={'query': query, 'variables': variables}
+    )
+    r.raise_for_status()
+    response = r.json()
+    if response.get('errors'):
+      raise GithubProjectError(f'Github GraphQL query failed: {response["errors"]}')
+    return response['data']
+
+  def _cached(self, key, loader, refresh=False):
+    cached = self.cache.get(key)
+    if refresh or not cached or monotonic() - cached[0] > CACHE_TTL:
+      cached = (monotonic(), loader())
+      self.cache[key] = cached
+    return cached[1]
+
+  def _load_teams(self):
+    teams = []
+    cursor = None
+    while True:
+      page = self._graphql(TEAMS_QUERY, {'org': self.github_org, 'cursor': cursor})[
+        'organization'
+      ]['teams']
+      # Same shape as the REST teams list
+      teams.extend(
+        {'id': team['databaseId'], 'name': team['name'], 'slug': team['slug']}
+        for team in page['nodes']
+      )
+      if not page['pageInfo']['hasNextPage']:
+        return teams
+      cursor = page['pageInfo']['endCursor']
+
+  def _teams_cached(self):
+    return self._cached(('teams', self.github_org), self._load_teams)
+
+  def _load_runner_groups(self):
+    return {
+      g['name']: g['id']
+      for g in self._paginate(
+        f'{GITHUB_API_URL}/orgs/{self.github_org}/actions/runner-groups',
+        'runner_groups',
+      )
+    }
+
+  def _runner_groups_cached(self, refresh=False):
+    # runner group name -> id
+    return self._cached(
+      ('runner_groups', self.github_org), self._load_runner_groups, refresh
+    )
 
   def get_teams(self):
     try:
-      self.teams = self.org.get_teams()
-      self.team_slugs = {team.slug for team in self.teams}
-      log.debug(f'Loaded list of {len(self.team_slugs)} team slugs')
+      self.teams = self._teams_cached()
+      self.team_slugs = {team['slug'] for team in self.teams}
+      log.debug('Loaded list of %d team slugs', len(self.team_slugs))
       return True
     except Exception as e:
       log.error(f'Unable to load github teams because: {e}')
       return None
 
+  def _get_main_sha(self):
+    # main only moves when a request PR is merged, so one lookup per run is enough
+    if not self.main_sha:
+      r = self.http.get(f'{self.bootstrap_url}/branches/main')
+      r.raise_for_status()
+      self.main_sha = r.json()['commit']['sha']
+    return self.main_sha
+
+  def _commit_files(self, branch, files, message, parent_sha=None):
+    # Write a set of {path: content} files to a branch as a single commit using
+    # the git data API - one tree, one commit and a ref update however many
+    # files there are, rather than a read and a commit per file
+    if not parent_sha:
+      r = self.http.get(f'{self.bootstrap_url}/git/ref/heads/{branch}')
+      r.raise_for_status()
+      parent_sha = r.json()['object']['sha']
+    r = self.http.get(f'{self.bootstrap_url}/git/commits/{parent_sha}')
+    r.raise_for_status()
+    base_tree = r.json()['tree']['sha']
+
+    r = self.http.post(
+      f'{self.bootstrap_url}/git/trees',
+      json={
+        'base_tree': base_tree,
+        'tree': [
+          {'path': path, 'mode': '100644', 'type': 'blob', 'content': content}
+          for path, content in files.items()
+        ],
+      },
+    )
+    r.raise_for_status()
+    tree_sha = r.json()['sha']
+
+    r = self.http.post(
+      f'{self.bootstrap_url}/git/commits',
+      json={'message': message, 'tree': tree_sha, 'parents': [parent_sha]},
+    )
+    r.raise_for_status()
+    commit_sha = r.json()['sha']
+
+    r = self.http.patch(
+      f'{self.bootstrap_url}/git/refs/heads/{branch}', json={'sha': commit_sha}
+    )
+    r.raise_for_status()
+    return commit_sha
+
+  def _enable_automerge(self, pr_node_id, branch_name):
+    try:
+      with self.write_semaphore:
+        self._graphql(ENABLE_AUTOMERGE_MUTATION, {'pullRequestId': pr_node_id})
+      return True
+    except (requests.exceptions.RequestException, GithubProjectError) as e:
+      log.warning(f'Unable to enable auto-merge on the PR for {branch_name}: {e}')
+      return False
+
   def create_update_pr(self, request):
     branch_name = f'REQ_{request["id"]}_{request.get("github_repo")}'
 
+    try:
+      branch_status = self._graphql(
+        BRANCH_STATUS_QUERY,
+        {
+          'owner': self.github_org,
+          'repo': self.github_bootstrap_repo,
+          'ref': f'refs/heads/{branch_name}',
+          'branch': branch_name,
+        },
+      )['repository']
+    except (requests.exceptions.RequestException, GithubProjectError) as e:
+      raise GithubProjectError(
+        f'Failed to look up branch {branch_name} in {self.github_bootstrap_repo} - {e}'
+      )
+
     # If the branch doesn't exist - create it
     # This will obviously create a new PR even if one already exists
-    all_branches = self.bootstrap_repo.get_branches()
-    if branch_name not in [branch.name for branch in all_branches]:
+    if branch_status['ref']:
+      branch_sha = branch_status['ref']['target']['oid']
+    else:
       log.info(f'Branch {branch_name} not found - creating')
-      self.bootstrap_repo.create_git_ref(
-        ref=f'refs/heads/{branch_name}',
-        sha=self.bootstrap_repo.get_branch('main').commit.sha,
-      )
+      try:
+        branch_sha = self._get_main_sha()
+        with self.write_semaphore:
+          r = self.create_http.post(
+            f'{self.bootstrap_url}/git/refs',
+            json={'ref': f'refs/heads/{branch_name}', 'sha': branch_sha},
+          )
+        r.raise_for_status()
+      except requests.exceptions.RequestException as e:
+        raise GithubProjectError(
+          f'Failed to create branch {branch_name} in {self.github_bootstrap_repo} - {e} - please fix this this and re-run'
+        )
 
     request_json_file = f'{branch_name}.json'
 
     # Populate the json file only with useful stuff
-    json_fields = [
-      'github_repo',
-      'repo_description',
-      'base_template',
-      'jira_project_keys',
-      'github_project_visibility',
-      'product',
-      'github_project_teams_write',
-      'github_projects_teams_admin',
-      'github_project_branch_protection_restricted_teams',
-      'prod_alerts_severity_label',
-      'nonprod_alerts_severity_label',
-      'slack_channel_nonprod_release_notify',
-      'slack_channel_prod_release_notify',
-      'slack_channel_security_scans_notify',
-      'requester_name',
-      'requester_email',
-      'requester_team',
-    ]
-
-    request_json = {key: request.get(key) for key in json_fields if key in request}
+    request_json = {
+      key: value for key, value in request.items() if key in REQUEST_JSON_FIELDS
+    }
+    request_json_content = json.dumps(request_json, indent=2, sort_keys=True)
 
-    create_file = False
-    # Check if the project-request.json file exists and update it if it does
+    # Check if the project-request.json file exists - it's created if not and
+    # updated if it is (unless nothing has changed)
     try:
-      json_file = self.bootstrap_repo.get_contents(
-        f'requests/{request_json_file}', ref=branch_name
+      r = self.http.get(
+        f'{self.bootstrap_url}/contents/requests/{request_json_file}',
+        params={'ref': branch_name},
       )
-      if json_file and not isinstance(json_file, list):
-        self.bootstrap_repo.update_file(
-          json_file.path,
-          f'Updating {request_json_file} with details for {request.get("github_repo")}',
-          json.dumps(request_json, indent=2),
-          json_file.sha,
-          branch=branch_name,
-        )
-
-    except GithubException as e:
-      if e.status == 404:
-        # Need to create the project.json file if it's not there
-        create_file = True
+      commit_message = None
+      if r.status_code == 404:
+        log.debug('Creating file: %s', request_json_file)
+        commit_message = f'Creating requests/{request_json_file} with details for {request.get("github_repo")}'
       else:
-        log.error(
-          f'Failed to update requests/{request_json_file} in {self.bootstrap_repo.name} - {e.data} - please fix this this and re-run'
-        )
-        sys.exit(1)
+        r.raise_for_status()
+        json_file = r.json()
+        if json_file and not isinstance(json_file, list):
+          # Don't commit (and kick off CI) if the request hasn't changed
+          if base64.b64decode(json_file['content']).decode() == request_json_content:
+            log.info(f'No changes to {request_json_file} - not updating')
+          else:
+            commit_message = f'Updating {request_json_file} with details for {request.get("github_repo")}'
+
+      if commit_message:
+        with self.write_semaphore:
+          self._commit_files(
+            branch_name,
+            {f'requests/{request_json_file}': request_json_content},
+            commit_message,
+            parent_sha=branch_sha,
+          )
 
-    if create_file:
-      try:
-        log.debug(f'Creating file: {request_json_file}')
-        self.bootstrap_repo.create_file(
-          f'requests/{request_json_file}',
-          f'Creating requests/{request_json_file} with details for {request.get("github_repo")}',
-          json.dumps(request_json, indent=2),
-          branch=branch_name,
-        )
-      except GithubException as e:
-        log.error(
-          f'Failed to create requests/{request_json_file} in {self.bootstrap_repo.name} - {e.data} - please fix this this and re-run'
-        )
-        sys.exit(1)
+    except requests.exceptions.RequestException as e:
+      raise GithubProjectError(
+        f'Failed to update requests/{request_json_file} in {self.github_bootstrap_repo} - {e} - please fix this this and re-run'
+      )
 
-    github_pulls = self.bootstrap_repo.get_pulls(
-      state='open',
-      sort='created',
-      base='main',
-      head=f'{self.github_org}:{branch_name}',
-    )
+    # headRefName alone would also match a branch of the same name in a fork
+    github_pulls = [
+      pr
+      for pr in branch_status['pullRequests']['nodes']
+      if (pr['headRepositoryOwner'] or {}).get('login', '').lower()
+      == self.github_org.lower()
+    ]
 
-    log.debug(f'Current pulls for {branch_name}: {github_pulls.totalCount}')
-    if github_pulls.totalCount == 0:
+    log.debug('Current pulls for %s: %d', branch_name, len(github_pulls))
+    if not github_pulls:
       # Create a new PR if one doesn't exist
       log.info(f'Creating PR for {branch_name}')
-      pr = self.bootstrap_repo.create_pull(
-        title=f'Project request for {request.get("github_repo")}',
-        body=f'Project request raised for {request.get("github_repo")}',
-        head=branch_name,
-        base='main',
-      )
-      pr.enable_automerge('MERGE')
-      request['request_github_pr_number'] = pr.number
+      try:
+        with self.write_semaphore:
+          r = self.create_http.post(
+            f'{self.bootstrap_url}/pulls',
+            json={
+              'title': f'Project request for {request.get("github_repo")}',
+              'body': f'Project request raised for {request.get("github_repo")}',
+              'head': branch_name,
+              'base': 'main',
+            },
+          )
+          r.raise_for_status()
+          pr = r.json()
+      except requests.exceptions.RequestException as e:
+        raise GithubProjectError(
+          f'Failed to create PR for {branch_name} in {self.github_bootstrap_repo} - {e} - please fix this this and re-run'
+        )
+      # The PR exists now whatever happens here, so a failure to turn on
+      # auto-merge is only a warning
+      self._enable_automerge(pr['node_id'], branch_name)
+      request['request_github_pr_number'] = pr['number']
       request['output_status'] = 'New'
       request['request_github_pr_status'] = 'Raised'
     else:
       log.info(f'PR already exists for {branch_name}')
-      request['request_github_pr_number'] = github_pulls[0].number
+      request['request_github_pr_number'] = github_pulls[0]['number']
       request['output_status'] = 'Updated'
       request['request_github_pr_status'] = 'Updated'
 
     return request
 
+  def process_requests(self, project_requests, max_workers=MAX_WORKERS):
+    # Each request has its own branch and file, so the pipelines are independent
+    # and can run side by side. Writes are still capped by write_semaphore.
+    # Returns the processed requests in the order they were given - a request
+    # that fails is marked as such and doesn't stop the rest
+    results = [None] * len(project_requests)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = {
+        executor.submit(self.create_update_pr, request): i
+        for i, request in enumerate(project_requests)
+      }
+      for future in as_completed(futures):
+        i = futures[future]
+        request = project_requests[i]
+        try:
+          results[i] = future.result()
+        except Exception as e:
+          # Anything going wrong with one request (including a malformed request
+          # or an unexpected response) shouldn't lose the results of the others
+          log.error(f'Unable to process request {request.get("id")}: {e}')
+          request['output_status'] = 'Failed'
+          request['output_error'] = str(e)
+          results[i] = request
+        log.debug('Request %s: %s', request.get('id'), request.get('output_status'))
+    return results
+
+  def _delete_workflow_run(self, run_id):
+    # Deletes count towards the secondary rate limits like any other write
+    with self.write_semaphore:
+      r = self.http.delete(f'{self.bootstrap_url}/actions/runs/{run_id}')
+    # 404 means it's already gone, which is what we wanted anyway
+    if r.status_code not in (204, 404):
+      log.warning(f'Unable to delete workflow run {run_id}: {r.status_code} - {r.text}')
+      return False
+    return True
+
+  def _delete_workflow_runs(self, run_ids):
+    # The deletes don't depend on each other so fire them off together
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+      deleted = sum(executor.map(self._delete_workflow_run, run_ids))
+    log.debug('Deleted %d of %d workflow runs', deleted, len(run_ids))
+    return deleted
+
+  def _old_workflow_run_ids(self, workflow_id):
+    # Ids of all but the newest WORKFLOW_RUNS_TO_KEEP runs of a workflow (runs
+    # are listed newest first). The first page says how many runs there are,
+    # so nothing more is fetched if there's nothing to delete, and paging stops
+    # as soon as every run to delete has been seen.
+    url = f'{self.bootstrap_url}/actions/workflows/{workflow_id}/runs'
+    params = {'per_page': 100, 'exclude_pull_requests': 'true', 'page': 1}
+    r = self.http.get(url, params=params)
+    r.raise_for_status()
+    total_count = r.json()['total_count']
+    if total_count <= WORKFLOW_RUNS_TO_KEEP:
+      return []
+
+    to_delete = total_count - WORKFLOW_RUNS_TO_KEEP
+    run_ids = [run['id'] for run in r.json()['workflow_runs'][WORKFLOW_RUNS_TO_KEEP:]]
+    while len(run_ids) < to_delete:
+      params['page'] += 1
+      r = self.http.get(url, params=params)
+      r.raise_for_status()
+      if not (runs := r.json()['workflow_runs']):
+        break
+      run_ids.extend(run['id'] for run in runs)
+    return run_ids[:to_delete]
+
   def delete_old_workflows(self):
     try:
-      if bootstrap_workflow := [
-        workflow
-        for workflow in self.bootstrap_repo.get_workflows()
-        if workflow.name == 'Bootstrap - poll for repo requests'
-      ]:
-        workflow_runs = bootstrap_workflow[0].get_runs()
-        run_qty = workflow_runs.totalCount
-        if run_qty > 12:
+      # Stop paging through workflows as soon as the bootstrap one turns up
+      if bootstrap_workflow := next(
+        (
+          workflow
+          for workflow in self._paginate(
+            f'{self.bootstrap_url}/actions/workflows', 'workflows'
+          )
+          if workflow['name'] == 'Bootstrap - poll for repo requests'
+        ),
+        None,
+      ):
+        if run_ids := self._old_workflow_run_ids(bootstrap_workflow['id']):
           log.debug(
-            f'Workflow {bootstrap_workflow[0].name} has {run_qty} runs - cropping to 12'
+            'Workflow %s has %d runs - cropping to %d',
+            bootstrap_workflow['name'],
+            len(run_ids) + WORKFLOW_RUNS_TO_KEEP,
+            WORKFLOW_RUNS_TO_KEEP,
           )
-          for run in workflow_runs[12:]:
-            run.delete()
+          self._delete_workflow_runs(run_ids)
 
-    except GithubException as e:
+    except requests.exceptions.RequestException as e:
       log.warning(
-        f'Encountered an issue removing old workflow runs in {self.bootstrap_repo.name} - {e.data} - please fix this this and re-run'
+        f'Encountered an issue removing old workflow runs in {self.github_bootstrap_repo} - {e} - please fix this this and re-run'
       )
 
   def get_repo(self, repo_name):
@@ -178,21 +620,14 @@ class GithubProject:
       if e.status == 404:
         return False
       else:
-        log.error(
+        raise GithubProjectError(
           f'Failed to get Github repository information for {repo_name}: {e.data} - please correct this and re-run'
         )
-        sys.exit(1)
     return True
 
   def create_repo(self, project_params):
     if project_params['github_template_repo']:
       # create repository from template
-      # Headers for the request
-      headers = {
-        'Authorization': f'token {self.github_access_token}',
-        'Accept': 'application/vnd.github.v3+json',
-      }
-
       # Data for the request
       data = {
         'owner': project_params['github_org'],
@@ -201,19 +636,17 @@ class GithubProject:
       }
 
       # Make the request to create a new repository from a template
-      response = requests.post(
-        f'https://api.github.com/repos/{project_params["github_org"]}/{project_params["github_template_repo"]}/generate',
-        headers=headers,
+      response = self.create_http.post(
+        f'{GITHUB_API_URL}/repos/{project_params["github_org"]}/{project_params["github_template_repo"]}/generate',
         json=data,
       )
 
       if response.status_code == 201:
         log.info(f'Repository {project_params["github_repo"]} created successfully.')
       else:
-        log.error(
+        raise GithubProjectError(
           f'Failed to create repository: {response.status_code} - {response.text}'
         )
-        sys.exit(1)
 
       # load the repo details into the repo object
       self.repo = self.session.get_repo(
@@ -223,11 +656,6 @@ class GithubProject:
     else:
       # create fresh new repository
 
-      headers = {
-        'Authorization': f'token {self.github_access_token}',
-        'Accept': 'application/vnd.github.v3+json',
-      }
-
       # Data for the request
       data = {
         'name': project_params['github_repo'],
@@ -235,19 +663,17 @@ class GithubProject:
       }
 
       # Make the request to create a new repository from a template
-      response = requests.post(
-        f'https://api.github.com/orgs/{project_params["github_org"]}/repos',
-        headers=headers,
+      response = self.create_http.post(
+        f'{GITHUB_API_URL}/orgs/{project_params["github_org"]}/repos',
         json=data,
       )
 
       if response.status_code == 201:
         log.info(f'Repository {project_params["github_repo"]} created successfully.')
       else:
-        log.error(
+        raise GithubProjectError(
           f'Failed to create repository: {response.status_code} - {response.text}'
         )
-        sys.exit(1)
 
       # and populate it with a basic README.md
       self.repo = self.session.get_repo(
@@ -260,30 +686,36 @@ class GithubProject:
         )
         self.repo.create_file(file_name, 'commit', file_contents)
       except GithubException as e:
-        log.error(
+        raise GithubProjectError(
           f'Failed to create Github README.md - {e.data} - please correct this and re-run'
         )
-        sys.exit(1)
 
-    # poll for the repo to prevent race conditions
+    # poll for the repo to prevent race conditions - it's usually ready well
+    # within a second, so start with a short wait and back off from there
     repo_ready = False
     check_count = 0
+    delay = REPO_READY_INITIAL_DELAY
     log.debug('Checking to see if the repo is ready yet..')
-    while not repo_ready and check_count < 10:
-      sleep(5)
+    while not repo_ready and check_count < REPO_READY_ATTEMPTS:
       try:
-        log.debug(f'Attempt: {check_count}')
-        self.repo.edit(default_branch='main')
-        repo_ready = True
+        log.debug('Attempt: %d', check_count)
+        r = self.http.head(
+          f'{GITHUB_API_URL}/repos/{project_params["github_org"]}/{project_params["github_repo"]}'
+        )
+        if r.status_code == 200:
+          self.repo.edit(default_branch='main')
+          repo_ready = True
+          continue
       except Exception:
-        check_count += 1
-        continue
+        pass
+      check_count += 1
+      sleep(delay)
+      delay = min(delay * 2, REPO_READY_MAX_DELAY)
 
     if not repo_ready:
-      log.error(
-        f'Repository {project_params["github_repo"]} not ready after 10 attempts - please check and re-run'
+      raise GithubProjectError(
+        f'Repository {project_params["github_repo"]} not ready after {REPO_READY_ATTEMPTS} attempts - please check and re-run'
       )
-      sys.exit(1)
 
   def add_repo_to_runner_group(self, repo_name, runner_group_name):
     repo = self.org.get_repo(repo_name)
@@ -294,38 +726,31 @@ class GithubProject:
       return False
     repo_id = repo.id
 
-    headers = {
-      'Authorization': f'token {self.github_access_token}',
-      'Accept': 'application/vnd.github.v3+json',
-    }
     try:
-      r = requests.get(
-        f'https://api.github.com/orgs/{self.github_org}/actions/runner-groups',
-        headers=headers,
-      )
-      r.raise_for_status()
-      groups = r.json().get('runner_groups', [])
-      if runner_group := next(g for g in groups if g['name'] == runner_group_name):
-        runner_group_id = runner_group['id']
-      else:
+      runner_group_id = self._runner_groups_cached().get(runner_group_name)
+      if runner_group_id is None:
+        # Might have been created since the list was cached
+        runner_group_id = self._runner_groups_cached(refresh=True).get(
+          runner_group_name
+        )
+      if runner_group_id is None:
         log.error(
           f'Runner group {runner_group_name} not found - not possible to add repository {repo_name} to runner group'
         )
         return False
-    except GithubException as e:
+    except requests.exceptions.RequestException as e:
       log.error(f'Unable to get a list of runner groups: {e}')
       return False
 
     try:
-      r = requests.put(
-        f'https://api.github.com/orgs/{self.github_org}/actions/runner-groups/{runner_group_id}/repositories/{repo_id}',
-        headers=headers,
+      r = self.http.put(
+        f'{GITHUB_API_URL}/orgs/{self.github_org}/actions/runner-groups/{runner_group_id}/repositories/{repo_id}',
       )
       r.raise_for_status()
       log.info(
         f'Repo {repo_name} added to runner group {runner_group_name} (id: {runner_group_id}).'
       )
-    except GithubException as e:
+    except requests.exceptions.RequestException as e:
       log.error(
         f'Unable to add repository {repo_name} to runner group {runner_group_name}: {e}'
       )